@@ -3,44 +3,54 @@
 """
 from __future__ import annotations
 
+import asyncio
 import os
+import time
+from functools import lru_cache
+from typing import AsyncIterator, Iterator
 
 import opencode_client as opencode
 import opencode_runner as runner
+import session_cache
 
 MAX_MESSAGE_LENGTH = 4096
-current_session_id: str | None = None
+# 流式输出：累计满 STREAM_FLUSH_SIZE 字或停顿 STREAM_FLUSH_IDLE 秒即发出一段
+STREAM_FLUSH_SIZE = 3500
+STREAM_FLUSH_IDLE = 0.3
+# /opencode 状态探测（端口 + 健康检查）结果的缓存时间，避免连续命令重复探测
+HEALTH_PROBE_TTL = 2.0
+# 每个聊天（Telegram chat_id / Matrix room_id）各自的当前会话，互不影响
+_sessions: dict[str, str] = {}
+_locks: dict[str, asyncio.Lock] = {}
 
 
-async def get_or_create_session() -> str:
-    global current_session_id
-    if current_session_id:
-        return current_session_id
-    sessions = await opencode.list_sessions()
-    if not sessions:
-        session = await opencode.create_session()
-        current_session_id = session["id"]
-    else:
-        current_session_id = sessions[0]["id"]
-    return current_session_id
+def _lock_for(key: str) -> asyncio.Lock:
+    return _locks.setdefault(key, asyncio.Lock())
 
 
-def switch_session(session_id: str) -> None:
-    global current_session_id
-    current_session_id = session_id
+async def get_or_create_session(key: str) -> str:
+    async with _lock_for(key):
+        session_id = _sessions.get(key)
+        if session_id:
+            return session_id
+        sessions = await session_cache.list_sessions()
+        if not sessions:
+            session = await session_cache.create_session()
+            session_id = session["id"]
+        else:
+            session_id = sessions[0]["id"]
+        _sessions[key] = session_id
+        return session_id
 
 
-def chunk_text(text: str, size: int = MAX_MESSAGE_LENGTH) -> list[str]:
-    if len(text) <= size:
-        return [text] if text else []
-    out = []
-    for i in range(0, len(text), size):
-        out.append(text[i : i + size])
-    return out
+def switch_session(key: str, session_id: str) -> None:
+    _sessions[key] = session_id
 
 
-async def get_sessions() -> list[dict]:
-    return await opencode.list_sessions()
+def chunk_text(text: str, size: int = MAX_MESSAGE_LENGTH) -> Iterator[str]:
+    """按 size 切分文本，逐段产出，不一次性生成整个列表。"""
+    for i in range(0, len(text), size):
+        yield text[i : i + size]
 
 
 def handle_start() -> str:
@@ -50,39 +60,69 @@ def handle_start() -> str:
     )
 
 
-async def handle_session_list() -> str:
+async def load_session_list(key: str) -> tuple[str, list[dict]]:
+    """一次请求同时得到 (会话列表文本, 会话列表)；获取失败时列表为空。"""
     try:
-        sessions = await opencode.list_sessions()
+        sessions = await session_cache.list_sessions()
     except Exception as e:
-        return f"获取会话失败: {e}"
+        return f"获取会话失败: {e}", []
     if not sessions:
-        return "当前无会话，发送任意消息将自动创建。"
+        return "当前无会话，发送任意消息将自动创建。", []
+    current = _sessions.get(key)
     lines = []
     for s in sessions:
         sid = s.get("id", "")
         title = s.get("title") or "(无标题)"
-        mark = " [当前]" if sid == current_session_id else ""
+        mark = " [当前]" if sid == current else ""
         lines.append(f"• {sid[:8]}… {title}{mark}")
-    return "会话列表（点击下方按钮切换当前会话）:\n" + "\n".join(lines)
+    return "会话列表（点击下方按钮切换当前会话）:\n" + "\n".join(lines), sessions
+
+
+async def handle_session_list(key: str) -> str:
+    text, _ = await load_session_list(key)
+    return text
 
 
-async def handle_new_session() -> str:
-    global current_session_id
+async def handle_new_session(key: str) -> str:
     try:
-        session = await opencode.create_session()
-        current_session_id = session["id"]
+        async with _lock_for(key):
+            session = await session_cache.create_session()
+            _sessions[key] = session["id"]
         return "已切换到新会话。"
     except Exception as e:
         return f"创建会话失败: {e}"
 
 
-def handle_opencode_status() -> str:
-    base = runner.get_base_url()
-    port = runner._parse_port_from_base_url(base)
+@lru_cache(maxsize=1)
+def _resolved_port() -> int:
+    """OPENCODE_BASE_URL 对应的本地端口（80/443 视为默认端口），进程内不变，解析一次即可。"""
+    port = runner._parse_port_from_base_url(runner.get_base_url())
     if port in (80, 443):
         port = runner.DEFAULT_PORT
-    in_use, pid, cmd = runner.check_port(port)
-    healthy = runner.is_opencode_healthy()
+    return port
+
+
+_probe_cache: dict[int, tuple[float, tuple[bool, int | None, str | None, bool]]] = {}
+
+
+async def _probe_opencode(port: int) -> tuple[bool, int | None, str | None, bool]:
+    """
+    返回 (端口占用, pid, 命令, 健康)，同一端口 HEALTH_PROBE_TTL 秒内复用上次结果。
+    端口检查放到线程中、健康检查走异步请求，不阻塞事件循环。
+    """
+    now = time.monotonic()
+    hit = _probe_cache.get(port)
+    if hit and hit[0] > now:
+        return hit[1]
+    in_use, pid, cmd = await asyncio.to_thread(runner.check_port, port)
+    result = (in_use, pid, cmd, await runner.is_opencode_healthy_async())
+    _probe_cache[port] = (now + HEALTH_PROBE_TTL, result)
+    return result
+
+
+async def handle_opencode_status() -> str:
+    port = _resolved_port()
+    in_use, pid, cmd, healthy = await _probe_opencode(port)
     lines = [
         f"端口: {port}",
         f"占用: {'是' if in_use else '否'}",
@@ -95,34 +135,86 @@ def handle_opencode_status() -> str:
     return "OpenCode 状态:\n" + "\n".join(lines)
 
 
-def is_opencode_healthy() -> bool:
-    return runner.is_opencode_healthy()
+async def is_opencode_healthy() -> bool:
+    return (await _probe_opencode(_resolved_port()))[3]
 
 
-def handle_start_opencode(log_path: str) -> tuple[bool, str]:
-    return runner.ensure_opencode_running(log_path=log_path)
+async def handle_start_opencode(log_path: str) -> tuple[bool, str]:
+    _probe_cache.clear()
+    return await runner.ensure_opencode_running_async(log_path=log_path)
 
 
-async def handle_switch_session(session_id: str) -> str:
+async def handle_switch_session(key: str, session_id: str, title: str | None = None) -> str:
+    """title 已知（如来自刚展示的按钮）时不再请求会话列表。"""
     try:
-        sessions = await opencode.list_sessions()
-        title = "(无标题)"
-        for s in sessions:
-            if s.get("id") == session_id:
-                title = s.get("title") or title
-                break
-        switch_session(session_id)
+        if title is None:
+            sessions = await session_cache.list_sessions()
+            title = "(无标题)"
+            for s in sessions:
+                if s.get("id") == session_id:
+                    title = s.get("title") or title
+                    break
+        switch_session(key, session_id)
         return f"已切换到会话: {title}"
     except Exception as e:
         return f"切换失败: {e}"
 
 
-async def handle_message(text: str) -> str:
+async def handle_message(key: str, text: str) -> str:
     try:
-        session_id = await get_or_create_session()
+        session_id = await get_or_create_session(key)
         result = await opencode.send_message(session_id, text)
     except Exception as e:
         return f"调用 OpenCode 失败: {e}"
     if not result:
         return "(无文本结果)"
     return result
+
+
+async def handle_message_stream(key: str, text: str) -> AsyncIterator[str]:
+    """handle_message 的流式版本：边执行边产出待发送的文本段（每段不超过 STREAM_FLUSH_SIZE 字）。"""
+    try:
+        session_id = await get_or_create_session(key)
+    except Exception as e:
+        yield f"调用 OpenCode 失败: {e}"
+        return
+    deltas = opencode.stream_message(session_id, text)
+    pending: asyncio.Future | None = None
+    buf = ""
+    sent = False
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(deltas.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=STREAM_FLUSH_IDLE if buf.strip() else None)
+            if not done:
+                yield buf
+                sent = True
+                buf = ""
+                continue
+            task, pending = pending, None
+            try:
+                buf += task.result()
+            except StopAsyncIteration:
+                break
+            while len(buf) >= STREAM_FLUSH_SIZE:
+                yield buf[:STREAM_FLUSH_SIZE]
+                sent = True
+                buf = buf[STREAM_FLUSH_SIZE:]
+    except Exception as e:
+        if buf.strip():
+            yield buf
+        yield f"调用 OpenCode 失败: {e}"
+        return
+    finally:
+        if pending is not None:
+            pending.cancel()
+            try:
+                await pending
+            except BaseException:
+                pass
+        await deltas.aclose()
+    if buf.strip():
+        yield buf
+    elif not sent:
+        yield "(无文本结果)"
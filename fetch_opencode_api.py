@@ -1,20 +1,34 @@
 """
-根据 opencode.md 用 curl 请求 OpenCode 各接口，将 curl 命令与响应保存到 opencode_api_ref/。
-需本地 opencode serve 已启动（默认 http://127.0.0.1:4096）。
+根据 opencode.md 请求 OpenCode 各接口（httpx 并发），将等价的 curl 命令与响应写入 opencode_api_ref/responses.jsonl。
+需本地 opencode serve 已启动（默认 http://127.0.0.1:4096）。传 --pretty 时将 JSON 响应缩进格式化后保存。
 """
 from __future__ import annotations
 
+import asyncio
 import json
 import os
 import re
-import subprocess
 import sys
 
+import httpx
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
 BASE = os.environ.get("OPENCODE_BASE_URL", "http://127.0.0.1:4096")
+BASE_CLEAN = BASE.rstrip("/")
 AUTH = os.environ.get("OPENCODE_SERVER_PASSWORD")
 OUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "opencode_api_ref")
 TIMEOUT_SSE = 2
+TIMEOUT_BLOCKING = 2
 TIMEOUT_NORMAL = 10
+SSE_IDLE = 0.5  # SSE 收到第一条事件或空闲这么久即断开
+SSE_PATHS = ("/global/event", "/event")
+BLOCKING_PATHS = ("/tui/control/next",)  # 可能一直阻塞到有控制请求
 
 # (method, path, 需要 :id 的 session?, 需要 :messageID?, query 示例, body 示例)
 ENDPOINTS = [
@@ -83,51 +97,68 @@ ENDPOINTS = [
 ]
 
 
+# 请求体只在导入时解析一次，请求时直接作为 json= 传给 httpx；原字符串仍用于生成 curl 命令
+BODIES = [json.loads(ep[5]) if ep[5] else None for ep in ENDPOINTS]
+
+# 按接口类型分组（保留原下标用于命名），三组各自用自己的超时并发请求
+NORMAL = [(i, ep) for i, ep in enumerate(ENDPOINTS) if ep[1] not in SSE_PATHS + BLOCKING_PATHS]
+SSE = [(i, ep) for i, ep in enumerate(ENDPOINTS) if ep[1] in SSE_PATHS]
+BLOCKING = [(i, ep) for i, ep in enumerate(ENDPOINTS) if ep[1] in BLOCKING_PATHS]
+
+_ID_RE = re.compile(r":\w+")
+
+
 def safe_name(method: str, path: str, query: str | None, idx: int) -> str:
     p = path.strip("/")
     p = p.replace("/", "_")
-    p = re.sub(r":\w+", "X", p)
+    p = _ID_RE.sub("X", p)
     if query:
         p += "_q"
     return f"{method}_{p}_{idx}"
 
 
-def run_curl(method: str, url: str, body: str | None, timeout: int) -> tuple[str, int, str]:
-    cmd = ["curl", "-s", "-w", "\n%{http_code}", "-X", method, "--max-time", str(timeout)]
-    if AUTH:
-        cmd.extend(["-u", f"opencode:{AUTH}"])
-    if body:
-        cmd.extend(["-H", "Content-Type: application/json", "-d", body])
-    cmd.append(url)
+async def fetch(
+    client: httpx.AsyncClient, method: str, url: str, body: dict | None, timeout: int
+) -> tuple[str, int, str]:
+    """返回 (响应文本, http 状态码, 错误信息)；超过 timeout 秒记为 (timeout)。"""
+    try:
+        r = await asyncio.wait_for(
+            client.request(method, url, json=body, timeout=timeout),
+            timeout,
+        )
+        return r.text.strip(), r.status_code, ""
+    except (asyncio.TimeoutError, httpx.TimeoutException):
+        return "(timeout)", 0, ""
+    except Exception as e:
+        return "", 0, str(e)
+
+
+async def fetch_sse(client: httpx.AsyncClient, method: str, url: str) -> tuple[str, int, str]:
+    """SSE 接口只读取第一条事件（或 SSE_IDLE 秒无新数据）即断开，不等满超时。"""
     try:
-        out = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout + 2)
-        stdout = (out.stdout or "").strip()
-        stderr = out.stderr or ""
-        if "\n" in stdout:
-            body_out, code = stdout.rsplit("\n", 1)
+        async with client.stream(method, url, timeout=TIMEOUT_SSE) as r:
+            lines: list[str] = []
+            it = r.aiter_lines()
             try:
-                code = int(code)
-            except ValueError:
-                code = 0
-        else:
-            body_out = stdout
-            code = 0
-        return body_out, code, stderr
-    except subprocess.TimeoutExpired:
+                while True:
+                    line = await asyncio.wait_for(it.__anext__(), SSE_IDLE)
+                    if line:
+                        lines.append(line)
+                    elif lines:
+                        break  # 空行表示一条事件结束
+            except (asyncio.TimeoutError, StopAsyncIteration):
+                pass
+            return "\n".join(lines), r.status_code, ""
+    except httpx.TimeoutException:
         return "(timeout)", 0, ""
     except Exception as e:
         return "", 0, str(e)
 
 
-def get_session_id() -> str | None:
-    url = f"{BASE.rstrip('/')}/session"
-    cmd = ["curl", "-s", "-X", "GET", "--max-time", str(TIMEOUT_NORMAL)]
-    if AUTH:
-        cmd.extend(["-u", f"opencode:{AUTH}"])
-    cmd.append(url)
+async def get_session_id(client: httpx.AsyncClient) -> str | None:
     try:
-        out = subprocess.run(cmd, capture_output=True, text=True, timeout=TIMEOUT_NORMAL + 2)
-        data = json.loads(out.stdout or "[]")
+        r = await client.get(f"{BASE_CLEAN}/session")
+        data = loads(r.content)
         if isinstance(data, list) and data and isinstance(data[0], dict) and "id" in data[0]:
             return data[0]["id"]
     except Exception:
@@ -135,15 +166,10 @@ def get_session_id() -> str | None:
     return None
 
 
-def get_message_id(session_id: str) -> str | None:
-    url = f"{BASE.rstrip('/')}/session/{session_id}/message?limit=3"
-    cmd = ["curl", "-s", "-X", "GET", "--max-time", str(TIMEOUT_NORMAL)]
-    if AUTH:
-        cmd.extend(["-u", f"opencode:{AUTH}"])
-    cmd.append(url)
+async def get_message_id(client: httpx.AsyncClient, session_id: str) -> str | None:
     try:
-        out = subprocess.run(cmd, capture_output=True, text=True, timeout=TIMEOUT_NORMAL + 2)
-        data = json.loads(out.stdout or "[]")
+        r = await client.get(f"{BASE_CLEAN}/session/{session_id}/message?limit=3")
+        data = loads(r.content)
         if isinstance(data, list) and data and isinstance(data[0], dict):
             info = data[0].get("info") or data[0]
             if isinstance(info, dict) and "id" in info:
@@ -153,18 +179,75 @@ def get_message_id(session_id: str) -> str | None:
     return None
 
 
-def main() -> None:
-    os.makedirs(OUT_DIR, exist_ok=True)
-    session_id = get_session_id()
-    message_id = get_message_id(session_id) if session_id else None
-    index = []
-    for idx, (method, path_orig, need_sid, need_mid, query, body) in enumerate(ENDPOINTS):
+async def discover_ids(client: httpx.AsyncClient) -> tuple[str | None, str | None]:
+    session_id = await get_session_id(client)
+    message_id = await get_message_id(client, session_id) if session_id else None
+    return session_id, message_id
+
+
+def build_jobs(group: list, timeout: int, session_id: str | None = None, message_id: str | None = None) -> list:
+    """把 (下标, 接口) 列表展开为 (下标, method, 原 path, query, body, url, timeout)。"""
+    jobs = []
+    for idx, (method, path_orig, need_sid, need_mid, query, body) in group:
         path = path_orig.replace(":id", session_id or ":id").replace(":messageID", message_id or ":messageID")
-        url = f"{BASE.rstrip('/')}{path}"
+        url = f"{BASE_CLEAN}{path}"
         if query:
             url += "?" + query
-        timeout = TIMEOUT_SSE if "/event" in path_orig or "control/next" in path_orig else TIMEOUT_NORMAL
-        body_out, code, stderr = run_curl(method, url, body, timeout)
+        jobs.append((idx, method, path_orig, query, body, url, timeout))
+    return jobs
+
+
+def _pretty_body(body_out: str) -> str:
+    """--pretty 时把 JSON 响应缩进格式化；非 JSON 原样返回。"""
+    if not body_out.startswith(("{", "[")):
+        return body_out
+    try:
+        return json.dumps(loads(body_out), indent=2, ensure_ascii=False)
+    except ValueError:
+        return body_out
+
+
+async def main_async(pretty: bool = False) -> None:
+    os.makedirs(OUT_DIR, exist_ok=True)
+    async with httpx.AsyncClient(
+        auth=("opencode", AUTH) if AUTH else None,
+        timeout=TIMEOUT_NORMAL,
+        limits=httpx.Limits(max_connections=32),
+    ) as client:
+        ids_task = asyncio.create_task(discover_ids(client))
+        # 不依赖 :id / :messageID 的 GET 立即开始，与获取 id 的两次请求重叠；
+        # 非 GET 会改变服务端状态（新建会话、dispose 等），不能与 id 发现同时进行
+        independent_all = build_jobs([(i, ep) for i, ep in NORMAL if not (ep[2] or ep[3])], TIMEOUT_NORMAL)
+        independent_jobs = [j for j in independent_all if j[1] == "GET"]
+        sse_jobs = build_jobs(SSE, TIMEOUT_SSE)
+        blocking_jobs = build_jobs(BLOCKING, TIMEOUT_BLOCKING)
+        independent = asyncio.gather(
+            asyncio.gather(*(fetch(client, m, url, BODIES[i], t) for i, m, _, _, _, url, t in independent_jobs)),
+            asyncio.gather(*(fetch_sse(client, m, url) for _, m, _, _, _, url, _ in sse_jobs)),
+            asyncio.gather(*(fetch(client, m, url, BODIES[i], t) for i, m, _, _, _, url, t in blocking_jobs)),
+        )
+        session_id, message_id = await ids_task
+        dependent_jobs = build_jobs(
+            [(i, ep) for i, ep in NORMAL if ep[2] or ep[3]], TIMEOUT_NORMAL, session_id, message_id
+        )
+        dependent_reads = [j for j in dependent_jobs if j[1] == "GET"]
+        writes = sorted(
+            [j for j in independent_all if j[1] != "GET"] + [j for j in dependent_jobs if j[1] != "GET"],
+            key=lambda j: j[0],
+        )
+        dependent_res = await asyncio.gather(
+            *(fetch(client, m, url, BODIES[i], t) for i, m, _, _, _, url, t in dependent_reads)
+        )
+        independent_res, sse_res, blocking_res = await independent
+        # 修改状态的请求（POST/PATCH/DELETE）等读请求全部完成后按 ENDPOINTS 顺序逐个执行，
+        # 保证 DELETE /session/:id 在同一会话的其他请求之后，样本结果可复现
+        write_res = [await fetch(client, m, url, BODIES[i], t) for i, m, _, _, _, url, t in writes]
+    jobs = independent_jobs + sse_jobs + blocking_jobs + dependent_reads + writes
+    results = independent_res + sse_res + blocking_res + dependent_res + write_res
+    done = sorted(zip(jobs, results), key=lambda x: x[0][0])
+    # 全部结果收集后一次写入 responses.jsonl（每行一个接口），不再每个接口单独写两个文件
+    records = []
+    for (idx, method, path_orig, query, body, url, timeout), (body_out, code, err) in done:
         name = safe_name(method, path_orig.split("?")[0], query, idx)
         curl_cmd = f"curl -s -X {method}"
         if AUTH:
@@ -172,28 +255,31 @@ def main() -> None:
         if body:
             curl_cmd += f" -H 'Content-Type: application/json' -d '{body}'"
         curl_cmd += f" --max-time {timeout} '{url}'"
-        curl_path = os.path.join(OUT_DIR, f"{name}.curl.txt")
-        with open(curl_path, "w", encoding="utf-8") as f:
-            f.write(curl_cmd)
-        resp_path = os.path.join(OUT_DIR, f"{name}.json")
-        try:
-            if body_out and body_out != "(timeout)" and (body_out.startswith("{") or body_out.startswith("[")):
-                json.loads(body_out)
-            with open(resp_path, "w", encoding="utf-8") as f:
-                f.write(body_out if body_out else "(empty)")
-        except (json.JSONDecodeError, TypeError):
-            with open(resp_path, "w", encoding="utf-8") as f:
-                f.write(body_out if body_out else "(empty)")
-        index.append((method, path_orig, name, code))
-    index_path = os.path.join(OUT_DIR, "index.txt")
-    with open(index_path, "w", encoding="utf-8") as f:
+        if pretty and body_out:
+            body_out = _pretty_body(body_out)
+        records.append(
+            {
+                "method": method,
+                "path": path_orig,
+                "name": name,
+                "http_code": code,
+                "curl": curl_cmd,
+                "body": body_out if body_out else "(empty)",
+            }
+        )
+    with open(os.path.join(OUT_DIR, "responses.jsonl"), "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+    with open(os.path.join(OUT_DIR, "index.txt"), "w", encoding="utf-8") as f:
         f.write("method\tpath\tname\thttp_code\n")
-        for method, path, name, code in index:
-            f.write(f"{method}\t{path}\t{name}\t{code}\n")
+        f.writelines(f"{r['method']}\t{r['path']}\t{r['name']}\t{r['http_code']}\n" for r in records)
     print(f"session_id={session_id}, message_id={message_id}")
-    print(f"wrote {len(ENDPOINTS)} entries to {OUT_DIR}")
-    for method, path, name, code in index:
-        print(f"  {method} {path} -> {name}.json ({code})")
+    print(f"wrote {len(records)} entries to {os.path.join(OUT_DIR, 'responses.jsonl')}")
+    for r in records:
+        print(f"  {r['method']} {r['path']} -> {r['name']} ({r['http_code']})")
+
+
+def main() -> None:
+    asyncio.run(main_async(pretty="--pretty" in sys.argv[1:]))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,40 @@
+"""
+JSON 读写：优先使用 orjson，未安装时退回标准库 json。
+"""
+from __future__ import annotations
+
+import copy
+import json
+import os
+from functools import lru_cache
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps_pretty(obj: Any) -> str:
+    """缩进 2 格，保留非 ASCII 字符原样输出。"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, indent=2, ensure_ascii=False)
+
+
+def load_file(path: str) -> Any:
+    """读取并解析 JSON 文件。按 (路径, 修改时间, 大小) 缓存解析结果，返回深拷贝，调用方修改不会影响缓存。"""
+    st = os.stat(path)
+    return copy.deepcopy(_load_file_cached(path, st.st_mtime_ns, st.st_size))
+
+
+@lru_cache(maxsize=8)
+def _load_file_cached(path: str, mtime_ns: int, size: int) -> Any:
+    with open(path, "rb") as f:
+        return loads(f.read())
@@ -6,7 +6,7 @@ from __future__ import annotations
 import asyncio
 import logging
 import os
-import threading
+import signal
 
 import opencode_runner as runner
 
@@ -17,6 +17,40 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+async def _run_both(config: dict) -> None:
+    """
+    Telegram 与 Matrix 共用一个事件循环。收到 SIGINT/SIGTERM 时两边一起停止；
+    一方正常结束不影响另一方；任一方异常退出时停止另一方并抛出该异常（进程以非 0 退出）。
+    """
+    import matrix_bot
+    from telegram_bot import run_telegram_async
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    telegram_task = asyncio.create_task(run_telegram_async(config, stop))
+    matrix_task = asyncio.create_task(matrix_bot.main_async())
+    stop_task = asyncio.create_task(stop.wait())
+    running = {telegram_task, matrix_task}
+    try:
+        while running and not stop.is_set():
+            done, _ = await asyncio.wait(running | {stop_task}, return_when=asyncio.FIRST_COMPLETED)
+            for task in done & running:
+                running.discard(task)
+                if not task.cancelled():
+                    # 异常在此抛出，finally 中停止另一方
+                    task.result()
+                logger.info("%s 已退出", "Telegram" if task is telegram_task else "Matrix")
+    finally:
+        stop.set()
+        matrix_task.cancel()
+        await asyncio.gather(telegram_task, matrix_task, stop_task, return_exceptions=True)
+
+
 def main() -> None:
     from telegram_bot import load_config, run_telegram
     import matrix_bot
@@ -32,10 +66,7 @@ def main() -> None:
         raise SystemExit("config.json 中需配置 telegram_token 或 matrix_homeserver+matrix_user_id")
 
     if has_telegram and has_matrix:
-        t = threading.Thread(target=run_telegram, args=(config,), daemon=True)
-        t.start()
-        logger.info("Telegram 已启动")
-        asyncio.run(matrix_bot.main_async())
+        asyncio.run(_run_both(config))
     elif has_telegram:
         run_telegram(config)
     else:
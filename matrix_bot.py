@@ -5,12 +5,14 @@ Matrix Bot：通过 matrix-nio 连接 Matrix，支持 E2EE；将用户消息转
 from __future__ import annotations
 
 import asyncio
-import json
 import logging
 import os
 import time
+from typing import Awaitable, Callable
 
 import bot_core
+import json_compat
+import opencode_client as opencode
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)s %(name)s: %(message)s",
@@ -22,33 +24,41 @@ ROOT = os.path.dirname(os.path.abspath(__file__))
 CREDENTIALS_PATH = os.path.join(ROOT, "matrix_credentials.json")
 STORE_PATH = os.path.join(ROOT, "matrix_store")
 CONFIG_PATH = os.path.join(ROOT, "config.json")
+# 长回复分段并发发送时同时在途的请求上限，避免触发家服务器限流
+MATRIX_SEND_CONCURRENCY = 4
 
 
 def _load_config() -> dict:
-    with open(CONFIG_PATH, encoding="utf-8") as f:
-        return json.load(f)
+    return json_compat.load_file(CONFIG_PATH)
+
+
+def _write_json_atomic(path: str, data: dict) -> None:
+    """先写临时文件再 os.replace，写到一半崩溃也不会丢失原文件。"""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(json_compat.dumps_pretty(data))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
 
 
 def _save_config(config: dict) -> None:
-    with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-        json.dump(config, f, indent=2, ensure_ascii=False)
+    _write_json_atomic(CONFIG_PATH, config)
 
 
 def _load_credentials() -> dict | None:
     if not os.path.isfile(CREDENTIALS_PATH):
         return None
-    with open(CREDENTIALS_PATH, encoding="utf-8") as f:
-        return json.load(f)
+    with open(CREDENTIALS_PATH, "rb") as f:
+        return json_compat.loads(f.read())
 
 
 def _save_credentials(access_token: str, device_id: str, user_id: str, homeserver: str) -> None:
     os.makedirs(ROOT, exist_ok=True)
-    with open(CREDENTIALS_PATH, "w", encoding="utf-8") as f:
-        json.dump(
-            {"access_token": access_token, "device_id": device_id, "user_id": user_id, "homeserver": homeserver},
-            f,
-            indent=2,
-        )
+    _write_json_atomic(
+        CREDENTIALS_PATH,
+        {"access_token": access_token, "device_id": device_id, "user_id": user_id, "homeserver": homeserver},
+    )
 
 
 def _remove_password_from_config() -> None:
@@ -59,6 +69,80 @@ def _remove_password_from_config() -> None:
         logger.info("已从 config.json 移除 matrix_password")
 
 
+async def _do_start(room_id: str, arg: str) -> str:
+    return bot_core.handle_start()
+
+
+async def _do_list(room_id: str, arg: str) -> str:
+    return await bot_core.handle_session_list(room_id)
+
+
+async def _do_new(room_id: str, arg: str) -> str:
+    return await bot_core.handle_new_session(room_id)
+
+
+async def _do_opencode(room_id: str, arg: str) -> str:
+    text = await bot_core.handle_opencode_status()
+    if not await bot_core.is_opencode_healthy():
+        log_path = os.path.join(ROOT, "opencode.log")
+        ok, msg = await bot_core.handle_start_opencode(log_path)
+        text = f"OpenCode: {msg}"
+    return text
+
+
+async def _do_use(room_id: str, arg: str) -> str:
+    return await bot_core.handle_switch_session(room_id, arg.strip())
+
+
+# 命令分发表：handler(room_id, 参数) -> 回复文本
+_COMMANDS: dict[str, Callable[[str, str], Awaitable[str]]] = {
+    "/start": _do_start,
+    "/session": _do_list,
+    "/sessions": _do_list,
+    "/new": _do_new,
+    "/opencode": _do_opencode,
+}
+_PREFIX_COMMANDS: tuple[tuple[str, Callable[[str, str], Awaitable[str]]], ...] = (
+    ("/use ", _do_use),
+)
+
+
+async def _device_cleanup(client, user_id: str, matrix_password: str) -> None:
+    """启动时执行一次：若账号下有其他设备则尝试登出（需要时用密码完成交互认证）。"""
+    from nio.responses import DeleteDevicesAuthResponse, DeleteDevicesResponse, DevicesResponse
+
+    try:
+        dev_resp = await client.devices()
+        if isinstance(dev_resp, DevicesResponse) and getattr(dev_resp, "devices", None):
+            devices = dev_resp.devices
+            n = len(devices)
+            if n <= 1:
+                logger.info("当前账号仅一台设备；消除 Element「bot 账户没有作自我验证」需在 Element 中以该账号完成安全设置中的验证/cross-signing（matrix-nio 暂不支持在 bot 内完成）")
+            else:
+                other_ids = [d.id for d in devices if d.id != client.device_id]
+                if not other_ids:
+                    logger.info("当前账号仅一台设备")
+                else:
+                    del_resp = await client.delete_devices(other_ids)
+                    if isinstance(del_resp, DeleteDevicesResponse):
+                        logger.info("已强制登出其他 %d 台设备", len(other_ids))
+                    elif isinstance(del_resp, DeleteDevicesAuthResponse) and matrix_password:
+                        del_resp2 = await client.delete_devices(
+                            other_ids,
+                            auth={"type": "m.login.password", "user": user_id, "password": matrix_password},
+                        )
+                        if isinstance(del_resp2, DeleteDevicesResponse):
+                            logger.info("已强制登出其他 %d 台设备", len(other_ids))
+                        else:
+                            logger.warning("登出其他设备认证失败")
+                    elif isinstance(del_resp, DeleteDevicesAuthResponse):
+                        logger.warning("登出其他设备需要密码认证，请在 config 中设置 matrix_password 或 matrix_password_for_uia 后重启，或手动在 Element 中登出其他设备")
+                    else:
+                        logger.warning("登出其他设备失败: %s", del_resp)
+    except Exception as e:
+        logger.debug("获取设备列表或登出其他设备失败: %s", e)
+
+
 async def _run_matrix(
     homeserver: str,
     user_id: str,
@@ -67,31 +151,39 @@ async def _run_matrix(
     allowed_room_ids: list[str],
     allowed_user_ids: list[str],
     matrix_password: str = "",
+    stream_output: bool = False,
 ) -> None:
     from nio import AsyncClient, AsyncClientConfig, MegolmEvent, RoomMessageText, SyncResponse
     from nio.exceptions import LocalProtocolError
-    from nio.responses import DeleteDevicesAuthResponse, DeleteDevicesResponse, DevicesResponse
     from nio.store import SqliteStore
 
     os.makedirs(STORE_PATH, exist_ok=True)
     config = AsyncClientConfig(store=SqliteStore, store_sync_tokens=True)
     client = AsyncClient(homeserver, user_id, device_id=device_id, store_path=STORE_PATH, config=config)
     client.restore_login(user_id, device_id, access_token)
-    start_ts_ms = int(time.time() * 1000)
+    cutoff_ms = int(time.time() * 1000) - 60_000
 
-    def is_old_event(event) -> bool:
+    def is_old_event(event, _cutoff: int = cutoff_ms) -> bool:
         """仅处理启动后的消息，避免对历史记录全部回复。"""
-        ts = getattr(event, "server_timestamp", 0) or 0
-        return ts < start_ts_ms - 60_000
+        return (event.server_timestamp or 0) < _cutoff
 
     async def send_text(room_id: str, text: str) -> None:
-        for chunk in bot_core.chunk_text(text):
-            await client.room_send(
-                room_id,
-                message_type="m.room.message",
-                content={"msgtype": "m.notice", "body": chunk},
-                ignore_unverified_devices=True,
-            )
+        n = -(-len(text) // bot_core.MAX_MESSAGE_LENGTH)
+        chunks = enumerate(bot_core.chunk_text(text), 1)
+
+        async def worker() -> None:
+            # 多个 worker 共用同一个分段迭代器，同时只有在途的几段存在于内存
+            for i, chunk in chunks:
+                # 分段并发发送，到达顺序不保证，加 [i/N] 序号便于阅读
+                body = f"[{i}/{n}]\n{chunk}" if n > 1 else chunk
+                await client.room_send(
+                    room_id,
+                    message_type="m.room.message",
+                    content={"msgtype": "m.notice", "body": body},
+                    ignore_unverified_devices=True,
+                )
+
+        await asyncio.gather(*(worker() for _ in range(min(n, MATRIX_SEND_CONCURRENCY))))
 
     async def on_message(room, event):
         try:
@@ -105,38 +197,27 @@ async def _run_matrix(
             if allowed_room_ids and room.room_id not in allowed_room_ids:
                 logger.info("忽略未允许房间的消息，将 room_id 加入 config allowed_room_ids 可回复: %s", room.room_id)
                 return
-            body = getattr(event, "body", None) or getattr(event, "decrypted_body", None) or ""
-            body = (body or "").strip()
+            body = (event.body or "").strip()
             if not body:
                 return
 
-            if body == "/start":
-                await send_text(room.room_id, bot_core.handle_start())
-                return
-            if body in ("/session", "/sessions"):
-                text = await bot_core.handle_session_list()
-                await send_text(room.room_id, text)
-                return
-            if body == "/new":
-                text = await bot_core.handle_new_session()
-                await send_text(room.room_id, text)
-                return
-            if body == "/opencode":
-                text = bot_core.handle_opencode_status()
-                if not bot_core.is_opencode_healthy():
-                    log_path = os.path.join(ROOT, "opencode.log")
-                    ok, msg = bot_core.handle_start_opencode(log_path)
-                    text = f"OpenCode: {msg}"
-                await send_text(room.room_id, text)
-                return
-            if body.startswith("/use "):
-                sid = body[5:].strip()
-                text = await bot_core.handle_switch_session(sid)
-                await send_text(room.room_id, text)
+            handler = _COMMANDS.get(body)
+            arg = ""
+            if handler is None:
+                for prefix, prefix_handler in _PREFIX_COMMANDS:
+                    if body.startswith(prefix):
+                        handler, arg = prefix_handler, body[len(prefix) :]
+                        break
+            if handler is not None:
+                await send_text(room.room_id, await handler(room.room_id, arg))
                 return
 
             await send_text(room.room_id, "已收到，正在执行…")
-            result = await bot_core.handle_message(body)
+            if stream_output:
+                async for chunk in bot_core.handle_message_stream(room.room_id, body):
+                    await send_text(room.room_id, chunk)
+                return
+            result = await bot_core.handle_message(room.room_id, body)
             await send_text(room.room_id, result)
         except Exception as e:
             logger.exception("处理 Matrix 消息失败: %s", e)
@@ -167,8 +248,11 @@ async def _run_matrix(
     client.add_event_callback(on_message, RoomMessageText)
     client.add_event_callback(on_encrypted_undecryptable, MegolmEvent)
 
+    async def claim_keys():
+        return await client.keys_claim(client.get_users_for_key_claiming())
+
+    cleanup_task = asyncio.create_task(_device_cleanup(client, user_id, matrix_password))
     try:
-        device_count_checked = False
         while True:
             try:
                 sync_response = await client.sync(timeout=30000)
@@ -179,61 +263,28 @@ async def _run_matrix(
                             logger.info("已加入房间 %s", room_id)
                         except Exception as join_err:
                             logger.warning("加入房间 %s 失败: %s", room_id, join_err)
-                if not device_count_checked:
-                    device_count_checked = True
-                    try:
-                        dev_resp = await client.devices()
-                        if isinstance(dev_resp, DevicesResponse) and getattr(dev_resp, "devices", None):
-                            devices = dev_resp.devices
-                            n = len(devices)
-                            if n <= 1:
-                                logger.info("当前账号仅一台设备；消除 Element「bot 账户没有作自我验证」需在 Element 中以该账号完成安全设置中的验证/cross-signing（matrix-nio 暂不支持在 bot 内完成）")
-                            else:
-                                other_ids = [d.id for d in devices if d.id != client.device_id]
-                                if not other_ids:
-                                    logger.info("当前账号仅一台设备")
-                                else:
-                                    del_resp = await client.delete_devices(other_ids)
-                                    if isinstance(del_resp, DeleteDevicesResponse):
-                                        logger.info("已强制登出其他 %d 台设备", len(other_ids))
-                                    elif isinstance(del_resp, DeleteDevicesAuthResponse) and matrix_password:
-                                        del_resp2 = await client.delete_devices(
-                                            other_ids,
-                                            auth={"type": "m.login.password", "user": user_id, "password": matrix_password},
-                                        )
-                                        if isinstance(del_resp2, DeleteDevicesResponse):
-                                            logger.info("已强制登出其他 %d 台设备", len(other_ids))
-                                        else:
-                                            logger.warning("登出其他设备认证失败")
-                                    elif isinstance(del_resp, DeleteDevicesAuthResponse):
-                                        logger.warning("登出其他设备需要密码认证，请在 config 中设置 matrix_password 或 matrix_password_for_uia 后重启，或手动在 Element 中登出其他设备")
-                                    else:
-                                        logger.warning("登出其他设备失败: %s", del_resp)
-                    except Exception as e:
-                        logger.debug("获取设备列表或登出其他设备失败: %s", e)
                 await client.send_to_device_messages()
-                if getattr(client, "should_upload_keys", False):
-                    try:
-                        await client.keys_upload()
-                    except LocalProtocolError:
-                        pass
-                if getattr(client, "should_query_keys", False):
-                    try:
-                        await client.keys_query()
-                    except LocalProtocolError:
-                        pass
-                if getattr(client, "should_claim_keys", False):
-                    try:
-                        await client.keys_claim(client.get_users_for_key_claiming())
-                    except LocalProtocolError:
-                        pass
+                # 与 nio 自带 sync_forever 一致：需要的密钥请求并发发出
+                key_tasks = []
+                if client.should_upload_keys:
+                    key_tasks.append(client.keys_upload())
+                if client.should_query_keys:
+                    key_tasks.append(client.keys_query())
+                if client.should_claim_keys:
+                    key_tasks.append(claim_keys())
+                if key_tasks:
+                    for res in await asyncio.gather(*key_tasks, return_exceptions=True):
+                        if isinstance(res, Exception) and not isinstance(res, LocalProtocolError):
+                            raise res
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 logger.exception("matrix sync: %s", e)
                 await asyncio.sleep(5)
     finally:
+        cleanup_task.cancel()
         await client.close()
+        await opencode.aclose()
 
 
 async def main_async() -> None:
@@ -243,6 +294,7 @@ async def main_async() -> None:
     password = (config.get("matrix_password") or "").strip()
     allowed_room_ids = list(config.get("allowed_room_ids") or [])
     allowed_user_ids = list(config.get("allowed_user_ids") or [])
+    stream_output = bool(config.get("stream_output"))
 
     if not homeserver or not user_id:
         logger.warning("未配置 matrix_homeserver / matrix_user_id，跳过 Matrix")
@@ -257,7 +309,9 @@ async def main_async() -> None:
             logger.info("使用已保存的 token 登录 Matrix")
             user_id = (creds.get("user_id") or user_id).strip()
             homeserver = (creds.get("homeserver") or homeserver).strip()
-            await _run_matrix(homeserver, user_id, access_token, device_id, allowed_room_ids, allowed_user_ids, password_for_uia)
+            await _run_matrix(
+                homeserver, user_id, access_token, device_id, allowed_room_ids, allowed_user_ids, password_for_uia, stream_output
+            )
             return
 
     if not password:
@@ -278,7 +332,9 @@ async def main_async() -> None:
     _save_credentials(access_token, device_id, user_id, homeserver)
     _remove_password_from_config()
     logger.info("已保存 token，后续将使用 token 登录")
-    await _run_matrix(homeserver, user_id, access_token, device_id, allowed_room_ids, allowed_user_ids, password)
+    await _run_matrix(
+        homeserver, user_id, access_token, device_id, allowed_room_ids, allowed_user_ids, password, stream_output
+    )
 
 
 def main() -> None:
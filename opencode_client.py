@@ -1,18 +1,23 @@
 """
 OpenCode HTTP 客户端：健康检查、会话列表/创建、发消息。
 解析 POST /session/:id/message 响应时只提取最终结果（最后一条 text part）。
+stream_message 通过 /event 事件流逐段返回助手输出的文本。
 """
 from __future__ import annotations
 
 import os
-from typing import Optional, Tuple
+from functools import lru_cache
+from typing import AsyncIterator, Optional, Tuple
 
 import httpx
 
+import json_compat
+
 DEFAULT_BASE_URL = "http://127.0.0.1:4096"
 MESSAGE_TIMEOUT = 300.0
 
 
+@lru_cache(maxsize=1)
 def _auth() -> Optional[Tuple[str, str]]:
     password = os.environ.get("OPENCODE_SERVER_PASSWORD", "")
     if not password:
@@ -21,60 +26,132 @@ def _auth() -> Optional[Tuple[str, str]]:
     return (user, password)
 
 
+@lru_cache(maxsize=1)
 def _get_base_url() -> str:
     return os.environ.get("OPENCODE_BASE_URL", DEFAULT_BASE_URL)
 
 
 def _extract_final_result(data: dict) -> str:
     """从 POST /session/:id/message 的响应中只取最终结果（最后一个 text part）。"""
-    parts = data.get("parts") or []
-    text_parts = [p.get("text") for p in parts if p.get("type") == "text" and "text" in p]
-    if not text_parts:
-        return ""
-    return text_parts[-1].strip()
+    for p in reversed(data.get("parts") or ()):
+        if p.get("type") == "text" and "text" in p:
+            t = p["text"]
+            return t.strip() if t else ""
+    return ""
+
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """进程内共用一个 AsyncClient，复用连接池（keep-alive），首次使用时创建。"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=_get_base_url(),
+            auth=_auth(),
+            timeout=10.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        )
+    return _client
+
+
+async def aclose() -> None:
+    """关闭共用的 AsyncClient；之后再调用会重新创建。"""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.aclose()
+
+
+async def reload_env() -> None:
+    """环境变量（地址/密码）变化后调用：清除缓存并关闭共用连接，下次请求按新配置重建。"""
+    _auth.cache_clear()
+    _get_base_url.cache_clear()
+    await aclose()
 
 
 async def health() -> dict:
     """GET /global/health"""
-    async with httpx.AsyncClient(
-        base_url=_get_base_url(), auth=_auth(), timeout=10.0
-    ) as client:
-        r = await client.get("/global/health")
-        r.raise_for_status()
-        return r.json()
+    r = await _get_client().get("/global/health")
+    r.raise_for_status()
+    return json_compat.loads(r.content)
 
 
 async def list_sessions() -> list:
     """GET /session"""
-    async with httpx.AsyncClient(
-        base_url=_get_base_url(), auth=_auth(), timeout=10.0
-    ) as client:
-        r = await client.get("/session")
-        r.raise_for_status()
-        return r.json()
+    r = await _get_client().get("/session")
+    r.raise_for_status()
+    return json_compat.loads(r.content)
 
 
 async def create_session(title: Optional[str] = None) -> dict:
     """POST /session"""
-    async with httpx.AsyncClient(
-        base_url=_get_base_url(), auth=_auth(), timeout=10.0
-    ) as client:
-        r = await client.post("/session", json={"title": title} if title else {})
-        r.raise_for_status()
-        return r.json()
+    r = await _get_client().post("/session", json={"title": title} if title else {})
+    r.raise_for_status()
+    return json_compat.loads(r.content)
 
 
 async def send_message(session_id: str, text: str) -> str:
     """
     POST /session/:id/message，只返回解析出的最终结果（最后一条 text part）。
     """
-    async with httpx.AsyncClient(
-        base_url=_get_base_url(), auth=_auth(), timeout=MESSAGE_TIMEOUT
-    ) as client:
+    r = await _get_client().post(
+        f"/session/{session_id}/message",
+        json={"parts": [{"type": "text", "text": text}]},
+        timeout=MESSAGE_TIMEOUT,
+    )
+    r.raise_for_status()
+    data = json_compat.loads(r.content)
+    return _extract_final_result(data)
+
+
+async def stream_message(session_id: str, text: str) -> AsyncIterator[str]:
+    """
+    先订阅 GET /event，再 POST /session/:id/prompt_async，逐段产出助手 text part 新增的文本；
+    收到该会话的 session.idle 后结束。
+    """
+    client = _get_client()
+    async with client.stream("GET", "/event", timeout=httpx.Timeout(MESSAGE_TIMEOUT, connect=10.0)) as events:
+        events.raise_for_status()
         r = await client.post(
-            f"/session/{session_id}/message",
+            f"/session/{session_id}/prompt_async",
             json={"parts": [{"type": "text", "text": text}]},
         )
         r.raise_for_status()
-        data = r.json()
-        return _extract_final_result(data)
+        assistant_ids: set = set()
+        sent_len: dict[str, int] = {}
+        async for line in events.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            try:
+                event = json_compat.loads(line[5:])
+            except ValueError:
+                continue
+            etype = event.get("type")
+            props = event.get("properties") or {}
+            if etype == "message.updated":
+                info = props.get("info") or {}
+                if info.get("sessionID") == session_id and info.get("role") == "assistant":
+                    assistant_ids.add(info.get("id"))
+            elif etype == "message.part.updated":
+                part = props.get("part") or {}
+                if (
+                    part.get("sessionID") != session_id
+                    or part.get("type") != "text"
+                    or part.get("messageID") not in assistant_ids
+                ):
+                    continue
+                part_id = part.get("id", "")
+                part_text = part.get("text") or ""
+                if part_id not in sent_len:
+                    if sent_len:
+                        yield "\n\n"
+                    sent_len[part_id] = 0
+                if len(part_text) > sent_len[part_id]:
+                    yield part_text[sent_len[part_id] :]
+                    sent_len[part_id] = len(part_text)
+            elif etype == "session.error" and props.get("sessionID") == session_id:
+                raise RuntimeError(f"OpenCode 会话出错: {props.get('error')}")
+            elif etype == "session.idle" and props.get("sessionID") == session_id:
+                return
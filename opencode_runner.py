@@ -3,17 +3,31 @@
 """
 from __future__ import annotations
 
+import asyncio
+import atexit
+import errno
 import os
+import select
 import socket
 import subprocess
 import time
-from typing import Optional
+from typing import Iterator, Optional
 
 import httpx
 
+import opencode_client
+
 DEFAULT_PORT = 4096
 DEFAULT_HOST = "127.0.0.1"
 OPENCODE_SERVE_CMD = ["opencode", "serve"]
+# 启动后等待健康：间隔从 50ms 指数退避到 1s，总计最多约 10 秒
+HEALTH_POLL_FIRST_DELAY = 0.05
+HEALTH_POLL_MAX_DELAY = 1.0
+HEALTH_POLL_BUDGET = 10.0
+
+# 同步健康检查共用的连接，启动时轮询健康不必每次新建连接
+_health_client = httpx.Client(timeout=3, limits=httpx.Limits(max_keepalive_connections=2))
+atexit.register(_health_client.close)
 
 
 def get_base_url() -> str:
@@ -39,19 +53,91 @@ def _parse_port_from_base_url(url: str) -> int:
 def check_port(port: int) -> tuple[bool, Optional[int], Optional[str]]:
     """
     检查端口是否被占用。返回 (是否占用, pid 或 None, 进程简述或 None)。
+    Linux 下直接读 /proc/net/tcp 判断是否有进程监听，不向服务端建立连接。
     """
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(1)
-            s.connect((DEFAULT_HOST, port))
-    except (socket.error, OSError):
+    inodes = _listening_socket_inodes(port)
+    if inodes is not None:
+        if not inodes:
+            return False, None, None
+        pid, cmd = _pid_for_socket_inodes(inodes)
+        return True, pid, cmd
+    if not _can_connect(port):
         return False, None, None
     pid, cmd = _get_process_on_port(port)
     return True, pid, cmd
 
 
+def _can_connect(port: int, timeout: float = 0.5) -> bool:
+    """非阻塞 connect_ex + select 探测端口（无 /proc 时使用）。"""
+    in_progress = {errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK)}
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.setblocking(False)
+            err = s.connect_ex((DEFAULT_HOST, port))
+            if err == 0:
+                return True
+            if err not in in_progress:
+                return False
+            _, writable, _ = select.select([], [s], [], timeout)
+            return bool(writable) and s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+    except OSError:
+        return False
+
+
+def _listening_socket_inodes(port: int) -> Optional[set[str]]:
+    """从 /proc/net/tcp(6) 取监听 port 的 socket inode；两个文件都不可读（非 Linux）时返回 None。"""
+    inodes: set[str] = set()
+    readable = False
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        readable = True
+        for line in lines:
+            fields = line.split()
+            # sl local_address rem_address st ... inode；st == 0A 即 LISTEN
+            if len(fields) < 10 or fields[3] != "0A":
+                continue
+            if int(fields[1].rsplit(":", 1)[1], 16) == port:
+                inodes.add(fields[9])
+    return inodes if readable else None
+
+
+def _pid_for_socket_inodes(inodes: set[str]) -> tuple[Optional[int], Optional[str]]:
+    """扫描 /proc/*/fd，返回持有任一 socket inode 的进程 (pid, 命令)。"""
+    if not inodes:
+        return None, None
+    targets = {f"socket:[{inode}]" for inode in inodes}
+    with os.scandir("/proc") as procs:
+        for proc in procs:
+            if not proc.name.isdigit():
+                continue
+            try:
+                with os.scandir(f"/proc/{proc.name}/fd") as fds:
+                    for fd in fds:
+                        try:
+                            if os.readlink(fd.path) in targets:
+                                pid = int(proc.name)
+                                return pid, _read_cmdline(pid)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+    return None, None
+
+
+def _read_cmdline(pid: int) -> Optional[str]:
+    try:
+        with open(f"/proc/{pid}/cmdline") as f:
+            return f.read().replace("\0", " ").strip()[:80]
+    except Exception:
+        return None
+
+
 def _get_process_on_port(port: int) -> tuple[Optional[int], Optional[str]]:
-    """Linux: 用 lsof 或 ss 获取占用端口的进程 pid 与简要命令。"""
+    """/proc 不可用时（check_port 的回退路径）用 lsof/fuser/ss 获取占用端口的进程 pid 与简要命令。"""
     pid = None
     for prog in (["lsof", "-i", f":{port}", "-t"], ["fuser", f"{port}/tcp"]):
         try:
@@ -78,14 +164,7 @@ def _get_process_on_port(port: int) -> tuple[Optional[int], Optional[str]]:
                             break
         except (FileNotFoundError, subprocess.TimeoutExpired):
             pass
-    cmd = None
-    if pid:
-        try:
-            with open(f"/proc/{pid}/cmdline") as f:
-                cmd = f.read().replace("\0", " ").strip()[:80]
-        except Exception:
-            pass
-    return pid, cmd
+    return pid, _read_cmdline(pid) if pid else None
 
 
 def is_opencode_healthy() -> bool:
@@ -98,7 +177,7 @@ def is_opencode_healthy() -> bool:
             os.environ.get("OPENCODE_SERVER_PASSWORD"),
         )
     try:
-        r = httpx.get(f"{base.rstrip('/')}/global/health", auth=auth, timeout=3)
+        r = _health_client.get(f"{base.rstrip('/')}/global/health", auth=auth)
         if r.status_code == 200:
             data = r.json()
             return data.get("healthy") is True
@@ -107,6 +186,23 @@ def is_opencode_healthy() -> bool:
     return False
 
 
+async def is_opencode_healthy_async() -> bool:
+    """is_opencode_healthy 的异步版本，走 opencode_client 的共用连接。"""
+    try:
+        data = await opencode_client.health()
+        return data.get("healthy") is True
+    except Exception:
+        return False
+
+
+def _health_poll_delays() -> Iterator[float]:
+    delay, total = HEALTH_POLL_FIRST_DELAY, 0.0
+    while total < HEALTH_POLL_BUDGET:
+        yield delay
+        total += delay
+        delay = min(delay * 2, HEALTH_POLL_MAX_DELAY)
+
+
 def start_opencode(
     port: Optional[int] = None,
     hostname: Optional[str] = None,
@@ -164,8 +260,35 @@ def ensure_opencode_running(
     ok, msg = start_opencode(port=port, log_path=log_path)
     if not ok:
         return False, msg
-    for _ in range(10):
-        time.sleep(1)
+    for delay in _health_poll_delays():
+        time.sleep(delay)
         if is_opencode_healthy():
             return True, msg
     return False, "已启动但健康检查未通过，请稍后重试"
+
+
+async def ensure_opencode_running_async(
+    port: Optional[int] = None,
+    log_path: Optional[str] = None,
+) -> tuple[bool, str]:
+    """
+    ensure_opencode_running 的异步版本，供 bot 的 handler 使用，等待期间不阻塞事件循环。
+    """
+    if await is_opencode_healthy_async():
+        return True, "OpenCode 已在运行"
+    port = port or _parse_port_from_base_url(get_base_url())
+    if port == 80:
+        port = DEFAULT_PORT
+    in_use, pid, cmd = await asyncio.to_thread(check_port, port)
+    if in_use and not await is_opencode_healthy_async():
+        return False, f"端口 {port} 已被占用 (pid={pid}, {cmd or '?'})，但非 OpenCode"
+    if in_use:
+        return True, "OpenCode 已在运行"
+    ok, msg = start_opencode(port=port, log_path=log_path)
+    if not ok:
+        return False, msg
+    for delay in _health_poll_delays():
+        await asyncio.sleep(delay)
+        if await is_opencode_healthy_async():
+            return True, msg
+    return False, "已启动但健康检查未通过，请稍后重试"
@@ -0,0 +1,51 @@
+"""
+OpenCode 会话列表的短 TTL 缓存：连续点按钮/查列表时复用结果，并发调用合并为一次请求。
+新建会话后立即失效。
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+import opencode_client as opencode
+
+SESSION_LIST_TTL = 3.0
+
+
+def async_ttl_cache(ttl: float) -> Callable:
+    """缓存无参协程函数的结果 ttl 秒；同一时刻只有一个请求在途。"""
+
+    def decorator(func: Callable[[], Awaitable[Any]]) -> Callable[[], Awaitable[Any]]:
+        lock = asyncio.Lock()
+        entry: list = [None, 0.0]  # [value, expires_at]
+
+        @functools.wraps(func)
+        async def wrapper() -> Any:
+            async with lock:
+                if entry[1] > time.monotonic():
+                    return entry[0]
+                value = await func()
+                entry[0], entry[1] = value, time.monotonic() + ttl
+                return value
+
+        def invalidate() -> None:
+            entry[0], entry[1] = None, 0.0
+
+        wrapper.invalidate = invalidate
+        return wrapper
+
+    return decorator
+
+
+@async_ttl_cache(ttl=SESSION_LIST_TTL)
+async def list_sessions() -> list:
+    return await opencode.list_sessions()
+
+
+async def create_session(title: Optional[str] = None) -> dict:
+    try:
+        return await opencode.create_session(title)
+    finally:
+        list_sessions.invalidate()
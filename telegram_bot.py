@@ -1,10 +1,12 @@
 """
 Telegram Bot：将用户消息转发给 OpenCode，仅把最终结果回复给用户。
 配置从 config.json 读取：telegram_token、allowed_chat_ids（允许使用的 chat id 列表）。
+可选 stream_output：为 true 时边执行边分段回复，而非只回复最终结果。
+可选 webhook_url / webhook_listen / webhook_port / webhook_secret_token：配置 webhook_url 时用 webhook 接收更新，否则长轮询。
 """
 from __future__ import annotations
 
-import json
+import asyncio
 import os
 import logging
 
@@ -18,8 +20,10 @@ from telegram.ext import (
     filters,
 )
 
+import opencode_client as opencode
 import opencode_runner as runner
 import bot_core
+import json_compat
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)s %(name)s: %(message)s",
@@ -27,26 +31,38 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-allowed_chat_ids: set[int] = set()
+stream_output = False
 
 CALLBACK_PREFIX_USE = "use_"
 CALLBACK_START_OPENCODE = "start_opencode"
+MAX_CALLBACK_DATA_BYTES = 64
 
 
-class AllowChatFilter(filters.BaseFilter):
-    def filter(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-        if not allowed_chat_ids:
+class AllowChatFilter(filters.UpdateFilter):
+    """仅放行 allow 中的 chat；allow 为 None 表示不限制。"""
+
+    def __init__(self, allow: frozenset[int] | None) -> None:
+        super().__init__(name="AllowChatFilter")
+        self._allow = allow
+
+    def filter(self, update: Update) -> bool:
+        if self._allow is None:
             return True
-        chat = update.effective_chat
-        return chat is not None and chat.id in allowed_chat_ids
+        c = update.effective_chat
+        return c is not None and c.id in self._allow
+
+
+# 按钮回调（CallbackQueryHandler 不支持 filters）也用同一份允许列表判断
+chat_filter = AllowChatFilter(None)
 
 
 def _session_keyboard(sessions: list) -> InlineKeyboardMarkup:
-    buttons = []
-    for s in sessions:
-        sid = s.get("id", "")
-        title = (s.get("title") or "(无标题)")[:40]
-        buttons.append([InlineKeyboardButton(title, callback_data=CALLBACK_PREFIX_USE + sid)])
+    # callback_data 上限 64 字节，超长的会话 id 无法放进按钮，直接跳过
+    buttons = [
+        [InlineKeyboardButton((s.get("title") or "(无标题)")[:40], callback_data=data)]
+        for s in sessions
+        if len((data := f"{CALLBACK_PREFIX_USE}{s.get('id', '')}").encode()) <= MAX_CALLBACK_DATA_BYTES
+    ]
     return InlineKeyboardMarkup(buttons)
 
 
@@ -54,12 +70,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(bot_core.handle_start())
 
 
+def _chat_key(update: Update) -> str:
+    return str(update.effective_chat.id)
+
+
 async def cmd_session(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    text = await bot_core.handle_session_list()
-    sessions = await bot_core.get_sessions()
+    text, sessions = await bot_core.load_session_list(_chat_key(update))
     if not sessions:
         await update.message.reply_text(text)
         return
+    # 记下按钮对应的标题，切换时直接取用，无需再请求会话列表
+    context.bot_data.setdefault("session_titles", {}).update(
+        {s.get("id", ""): s.get("title") or "(无标题)" for s in sessions}
+    )
     await update.message.reply_text(text, reply_markup=_session_keyboard(sessions))
 
 
@@ -67,24 +90,25 @@ async def on_switch_session(update: Update, context: ContextTypes.DEFAULT_TYPE)
     q = update.callback_query
     if not q or not q.data or not q.data.startswith(CALLBACK_PREFIX_USE):
         return
-    if allowed_chat_ids and update.effective_chat and update.effective_chat.id not in allowed_chat_ids:
+    if not chat_filter.filter(update):
         await q.answer()
         return
     await q.answer()
     session_id = q.data[len(CALLBACK_PREFIX_USE) :]
-    text = await bot_core.handle_switch_session(session_id)
+    title = context.bot_data.get("session_titles", {}).get(session_id)
+    text = await bot_core.handle_switch_session(_chat_key(update), session_id, title)
     await q.edit_message_text(text)
 
 
 async def cmd_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    text = await bot_core.handle_new_session()
+    text = await bot_core.handle_new_session(_chat_key(update))
     await update.message.reply_text(text)
 
 
 async def cmd_opencode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    text = bot_core.handle_opencode_status()
+    text = await bot_core.handle_opencode_status()
     keyboard = None
-    if not bot_core.is_opencode_healthy():
+    if not await bot_core.is_opencode_healthy():
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("启动 OpenCode", callback_data=CALLBACK_START_OPENCODE)]
         ])
@@ -95,12 +119,12 @@ async def on_start_opencode(update: Update, context: ContextTypes.DEFAULT_TYPE)
     q = update.callback_query
     if not q or q.data != CALLBACK_START_OPENCODE:
         return
-    if allowed_chat_ids and update.effective_chat and update.effective_chat.id not in allowed_chat_ids:
+    if not chat_filter.filter(update):
         await q.answer()
         return
     await q.answer()
     log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "opencode.log")
-    ok, msg = bot_core.handle_start_opencode(log_path)
+    ok, msg = await bot_core.handle_start_opencode(log_path)
     await q.edit_message_text(f"OpenCode: {msg}")
 
 
@@ -111,32 +135,42 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     if not text:
         return
     await update.message.reply_text("已收到，正在执行…")
-    result = await bot_core.handle_message(text)
+    if stream_output:
+        async for chunk in bot_core.handle_message_stream(_chat_key(update), text):
+            await update.message.reply_text(chunk)
+        return
+    result = await bot_core.handle_message(_chat_key(update), text)
     for chunk in bot_core.chunk_text(result):
         await update.message.reply_text(chunk)
 
 
-def run_telegram(config: dict) -> None:
-    global allowed_chat_ids
+BOT_COMMANDS = [
+    BotCommand("start", "欢迎与说明"),
+    BotCommand("session", "查看会话列表"),
+    BotCommand("new", "新建会话"),
+    BotCommand("opencode", "查看并启动 OpenCode"),
+]
+
+
+def _build_application(config: dict) -> Application | None:
+    """读取配置并注册全部 handler；未配置 telegram_token 时返回 None。"""
+    global chat_filter, stream_output
     token = (config.get("telegram_token") or "").strip()
     if not token:
-        return
-    allowed_chat_ids = set(int(x) for x in config.get("allowed_chat_ids") or [])
-    root = os.path.dirname(os.path.abspath(__file__))
-    ok, msg = runner.ensure_opencode_running(log_path=os.path.join(root, "opencode.log"))
-    logger.info("OpenCode: %s", msg)
-    commands = [
-        BotCommand("start", "欢迎与说明"),
-        BotCommand("session", "查看会话列表"),
-        BotCommand("new", "新建会话"),
-        BotCommand("opencode", "查看并启动 OpenCode"),
-    ]
+        return None
+    allowed_chat_ids = frozenset(int(x) for x in config.get("allowed_chat_ids") or [])
+    chat_filter = AllowChatFilter(allowed_chat_ids or None)
+    stream_output = bool(config.get("stream_output"))
 
     async def post_init(application: Application) -> None:
-        await application.bot.set_my_commands(commands)
+        await application.bot.set_my_commands(BOT_COMMANDS)
+
+    async def post_shutdown(application: Application) -> None:
+        await opencode.aclose()
 
-    allow = AllowChatFilter()
-    app = Application.builder().token(token).post_init(post_init).build()
+    # 不限制时用 filters.ALL，PTB 无需调用自定义过滤器
+    allow = chat_filter if allowed_chat_ids else filters.ALL
+    app = Application.builder().token(token).post_init(post_init).post_shutdown(post_shutdown).build()
     app.add_handler(CommandHandler("start", start, filters=allow))
     app.add_handler(CommandHandler("session", cmd_session, filters=allow))
     app.add_handler(CommandHandler("sessions", cmd_session, filters=allow))
@@ -145,7 +179,62 @@ def run_telegram(config: dict) -> None:
     app.add_handler(CallbackQueryHandler(on_switch_session, pattern=rf"^{CALLBACK_PREFIX_USE}"))
     app.add_handler(CallbackQueryHandler(on_start_opencode, pattern=rf"^{CALLBACK_START_OPENCODE}$"))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & allow, on_message))
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    return app
+
+
+def _webhook_kwargs(config: dict) -> dict | None:
+    """配置了 webhook_url 时返回 run_webhook / start_webhook 参数，否则 None（使用长轮询）。"""
+    webhook_url = (config.get("webhook_url") or "").strip()
+    if not webhook_url:
+        return None
+    token = config["telegram_token"].strip()
+    # 有可访问的 HTTPS 地址时用 webhook，由 Telegram 主动推送，省去长轮询等待
+    return {
+        "listen": config.get("webhook_listen") or "0.0.0.0",
+        "port": int(config.get("webhook_port") or 8443),
+        "url_path": token,
+        "secret_token": config.get("webhook_secret_token") or None,
+        "webhook_url": f"{webhook_url.rstrip('/')}/{token}",
+    }
+
+
+def run_telegram(config: dict) -> None:
+    app = _build_application(config)
+    if app is None:
+        return
+    root = os.path.dirname(os.path.abspath(__file__))
+    ok, msg = runner.ensure_opencode_running(log_path=os.path.join(root, "opencode.log"))
+    logger.info("OpenCode: %s", msg)
+    webhook = _webhook_kwargs(config)
+    if webhook:
+        app.run_webhook(allowed_updates=Update.ALL_TYPES, **webhook)
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+async def run_telegram_async(config: dict, stop: asyncio.Event) -> None:
+    """在调用方的事件循环中运行 Telegram（供与 Matrix 共用一个循环），stop 被设置后退出。"""
+    app = _build_application(config)
+    if app is None:
+        return
+    async with app:
+        try:
+            await app.bot.set_my_commands(BOT_COMMANDS)
+            await app.start()
+            webhook = _webhook_kwargs(config)
+            if webhook:
+                await app.updater.start_webhook(allowed_updates=Update.ALL_TYPES, **webhook)
+            else:
+                await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            logger.info("Telegram 已启动")
+            await stop.wait()
+        finally:
+            # 启动中途失败时只停止已经启动的部分，避免 async with 退出时因应用仍在运行而再报错
+            if app.updater.running:
+                await app.updater.stop()
+            if app.running:
+                await app.stop()
+            await opencode.aclose()
 
 
 def load_config() -> dict:
@@ -153,8 +242,7 @@ def load_config() -> dict:
     path = os.path.join(root, "config.json")
     if not os.path.isfile(path):
         raise SystemExit("请创建 config.json（参考 config.json.example）")
-    with open(path, encoding="utf-8") as f:
-        return json.load(f)
+    return json_compat.load_file(path)
 
 
 def main() -> None:
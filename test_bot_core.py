@@ -0,0 +1,53 @@
+"""
+bot_core 冒烟测试：用假的 opencode_client / opencode_runner 代替真实依赖，无需 httpx 与 OpenCode 服务。
+运行：python -m unittest test_bot_core
+"""
+from __future__ import annotations
+
+import asyncio
+import importlib
+import sys
+import types
+import unittest
+
+
+def _import_bot_core(healthy: bool = True):
+    client = types.ModuleType("opencode_client")
+    runner = types.ModuleType("opencode_runner")
+    runner.DEFAULT_PORT = 4096
+    runner.get_base_url = lambda: "http://127.0.0.1:4096"
+    runner._parse_port_from_base_url = lambda url: 4096
+    runner.check_port = lambda port: (True, 1234, "opencode serve")
+
+    async def is_opencode_healthy_async() -> bool:
+        return healthy
+
+    runner.is_opencode_healthy_async = is_opencode_healthy_async
+    sys.modules["opencode_client"] = client
+    sys.modules["opencode_runner"] = runner
+    for name in ("session_cache", "bot_core"):
+        sys.modules.pop(name, None)
+    return importlib.import_module("bot_core")
+
+
+class HandleOpencodeStatusTest(unittest.TestCase):
+    def tearDown(self) -> None:
+        for name in ("opencode_client", "opencode_runner", "session_cache", "bot_core"):
+            sys.modules.pop(name, None)
+
+    def test_status_text(self) -> None:
+        bot_core = _import_bot_core()
+        text = asyncio.run(bot_core.handle_opencode_status())
+        self.assertIn("端口: 4096", text)
+        self.assertIn("占用: 是", text)
+        self.assertIn("健康: 是", text)
+        self.assertIn("进程: pid=1234", text)
+
+    def test_unhealthy(self) -> None:
+        bot_core = _import_bot_core(healthy=False)
+        self.assertIn("健康: 否", asyncio.run(bot_core.handle_opencode_status()))
+        self.assertFalse(asyncio.run(bot_core.is_opencode_healthy()))
+
+
+if __name__ == "__main__":
+    unittest.main()